@@ -1,6 +1,23 @@
+import codecs
 import io
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+logger = logging.getLogger(__name__)
+
+# Copy-on-write: seleções/renomeações viram views, copiadas só se alteradas.
+# No pandas 3 já é o padrão (e a opção está obsoleta), então só liga no 2.x.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 st.set_page_config(page_title="Juntar 25 condições", layout="wide")
 st.title("Extrair colunas por nome e juntar tudo em um arquivo")
@@ -18,23 +35,114 @@ COLS_WANTED = [
     "Comp2 duração (s)",
 ]
 
-def read_any_table(uploaded_file) -> pd.DataFrame:
-    name = uploaded_file.name.lower()
-    if name.endswith(".csv") or name.endswith(".txt"):
-        # utf-8-sig lida com BOM
-        return pd.read_csv(uploaded_file, encoding="utf-8-sig")
-    elif name.endswith(".xlsx") or name.endswith(".xlsm") or name.endswith(".xls"):
-        return pd.read_excel(uploaded_file, sheet_name=0, engine="openpyxl")
+# Dtype canônico das colunas numéricas (todas menos "K"): partes com o mesmo
+# dtype permitem que o concat reaproveite os buffers em vez de converter
+NUM_COLS = COLS_WANTED[1:]
+NUM_DTYPE = "double[pyarrow]"
+
+# Linhas mostradas na prévia (a tabela inteira só sob demanda)
+PREVIEW_ROWS = 500
+
+def read_csv_fast(data: bytes, usecols=None, nrows=None) -> pd.DataFrame:
+    """Lê CSV com o engine pyarrow (multithread); cai no engine C se falhar."""
+    # O engine pyarrow não aceita utf-8-sig: pula o BOM manualmente
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    if nrows is not None:
+        # nrows não é suportado pelo engine pyarrow (leitura só do cabeçalho)
+        return pd.read_csv(io.BytesIO(data), encoding="utf-8", usecols=usecols, nrows=nrows)
+    try:
+        return pd.read_csv(
+            io.BytesIO(data), engine="pyarrow", dtype_backend="pyarrow", encoding="utf-8", usecols=usecols
+        )
+    except Exception:
+        # Arquivo malformado: tenta de novo com o engine C (mais tolerante)
+        return pd.read_csv(io.BytesIO(data), encoding="utf-8", usecols=usecols, dtype_backend="pyarrow")
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def read_any_table(name: str, data: bytes, usecols=None, nrows=None) -> pd.DataFrame:
+    """Lê a primeira planilha/tabela; usecols faz o parser pular as demais colunas.
+
+    Recebe o conteúdo em bytes para que o cache seja indexado pelo conteúdo
+    do arquivo: reruns do Streamlit com os mesmos uploads não re-leem nada.
+    """
+    lower = name.lower()
+    if lower.endswith(".csv") or lower.endswith(".txt"):
+        return read_csv_fast(data, usecols=usecols, nrows=nrows)
+    elif lower.endswith(".xlsx") or lower.endswith(".xlsm") or lower.endswith(".xls"):
+        return pd.read_excel(
+            io.BytesIO(data), sheet_name=0, engine="calamine", usecols=usecols, nrows=nrows, dtype_backend="pyarrow"
+        )
     else:
-        raise ValueError(f"Formato não suportado: {uploaded_file.name}")
+        raise ValueError(f"Formato não suportado: {name}")
+
+def read_header(name: str, data: bytes) -> pd.Index:
+    """Lê apenas o cabeçalho (nenhuma linha de dados)."""
+    return read_any_table(name, data, nrows=0).columns
+
+_WS = re.compile(r"\s+")
+# Qualquer espaço em branco que não seja um espaço simples isolado
+_WS_EXTRA = re.compile(r"\s{2,}|[^\S ]")
 
 def normalize_col(s: str) -> str:
     """Normaliza para comparar nomes de colunas (remove espaços extras)."""
-    return " ".join(str(s).strip().split())
-
-def build_col_map(df: pd.DataFrame):
-    """Mapa: nome_normalizado -> nome_original"""
-    return {normalize_col(c): c for c in df.columns}
+    s = str(s).strip()
+    # Caso comum (cabeçalho já limpo): nada a substituir
+    if _WS_EXTRA.search(s) is None:
+        return s
+    return _WS.sub(" ", s)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def to_csv_bytes(uploads: tuple, _df: pd.DataFrame) -> bytes:
+    """CSV em UTF-8 com BOM (abre certo no Excel), escrito direto em bytes pelo pyarrow.
+
+    O cache é indexado por `uploads` (pares nome/bytes que geraram `_df`), não
+    pelo DataFrame: o hash do Streamlit para DataFrames grandes usa só uma
+    amostra das linhas e poderia devolver um CSV antigo.
+    """
+    # Colunas object com tipos misturados (ex.: número em um arquivo, "-" em
+    # outro) não convertem para Arrow: escreve essas colunas como texto
+    df = _df.astype({c: "string[pyarrow]" for c in _df.select_dtypes("object").columns})
+    buf = io.BytesIO()
+    buf.write(codecs.BOM_UTF8)
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
+
+# Nomes desejados já normalizados (constante, calculada uma vez)
+WANTED_NORM = tuple(normalize_col(c) for c in COLS_WANTED)
+WANTED_NORM_SET = frozenset(WANTED_NORM)
+
+@lru_cache(maxsize=128)
+def build_col_map(columns: tuple):
+    """Mapa: nome_normalizado -> nome_original (cacheado por cabeçalho)"""
+    return {normalize_col(c): c for c in columns}
+
+class MissingColumnsError(ValueError):
+    """Arquivo sem alguma das COLS_WANTED (erro de validação, não falha inesperada)."""
+
+def read_wanted_columns(name: str, data: bytes) -> pd.DataFrame:
+    """Lê de um arquivo só as COLS_WANTED, na ordem de COLS_WANTED (nomes originais)."""
+    # Cabeçalho primeiro: resolve os nomes sem ler os dados
+    col_map = build_col_map(tuple(read_header(name, data)))
+
+    missing_norm = WANTED_NORM_SET.difference(col_map)
+    if missing_norm:
+        # Volta para os nomes originais, na ordem de COLS_WANTED
+        missing = [c for c, wn in zip(COLS_WANTED, WANTED_NORM) if wn in missing_norm]
+        raise MissingColumnsError(f"Faltando colunas: {missing}")
+
+    # Lê só as colunas desejadas (nomes originais do arquivo);
+    # usecols não preserva a ordem, então reordena em seguida
+    resolved = [col_map[wn] for wn in WANTED_NORM]
+    return read_any_table(name, data, usecols=resolved)[resolved]
+
+@st.fragment
+def show_preview(df: pd.DataFrame):
+    """Prévia da tabela; o checkbox reroda só este fragmento, não a leitura dos arquivos."""
+    if len(df) > PREVIEW_ROWS and not st.checkbox(f"Mostrar tudo ({len(df)} linhas)"):
+        st.caption(f"Mostrando as primeiras {PREVIEW_ROWS} linhas.")
+        df = df.head(PREVIEW_ROWS)
+    st.dataframe(df, use_container_width=True)
 
 st.info("Faça upload dos 25 arquivos (ou quantos quiser). O app vai extrair as colunas por nome e juntar tudo.")
 
@@ -48,50 +156,71 @@ if not files:
     st.stop()
 
 all_parts = []
+file_names = []
+file_lengths = []
 errors = []
 
-for f in files:
+# Leitura em paralelo (pyarrow/calamine liberam o GIL); o resto fica na thread principal.
+# Cada arquivo tem seu próprio future, então um arquivo com erro não derruba o lote.
+# As workers recebem o ScriptRunContext da sessão, senão o st.cache_data de
+# read_any_table avisa "missing ScriptRunContext" a cada chamada.
+ctx = get_script_run_ctx()
+with ThreadPoolExecutor(
+    max_workers=min(8, len(files)),
+    initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+) as ex:
+    futures = [ex.submit(read_wanted_columns, f.name, f.getvalue()) for f in files]
+
+for f, fut in zip(files, futures):
     try:
-        df = read_any_table(f)
-
-        col_map = build_col_map(df)
-        wanted_norm = [normalize_col(c) for c in COLS_WANTED]
-
-        missing = [COLS_WANTED[i] for i, wn in enumerate(wanted_norm) if wn not in col_map]
-        if missing:
-            errors.append((f.name, f"Faltando colunas: {missing}"))
-            continue
-
-        # Seleciona mantendo nomes originais do arquivo
-        selected = df[[col_map[wn] for wn in wanted_norm]].copy()
+        selected = fut.result()
 
         # Renomeia para os nomes padronizados (iguais para todos)
-        selected.columns = COLS_WANTED
-
-        # Rastreabilidade
-        selected.insert(0, "Arquivo", f.name)
+        selected = selected.set_axis(COLS_WANTED, axis=1)
+        # Só converte colunas já numéricas; uma coluna com texto (ex.: "-")
+        # fica como está em vez de derrubar o arquivo inteiro. Após o concat
+        # ela vira object (texto + número), que to_csv_bytes grava como texto
+        selected = selected.astype(
+            {c: NUM_DTYPE for c in NUM_COLS if pd.api.types.is_numeric_dtype(selected[c])}
+        )
+
+        # Rastreabilidade: a coluna "Arquivo" é criada depois do concat
+        file_names.append(f.name)
+        file_lengths.append(len(selected))
 
         all_parts.append(selected)
 
+    except MissingColumnsError as e:
+        # Validação esperada: sem traceback no log
+        logger.warning("%s: %s", f.name, e)
+        errors.append((f.name, str(e)))
+
     except Exception as e:
+        # Traceback completo vai para o log do servidor; na tela só a mensagem
+        logger.exception("Falha ao processar %s", f.name)
         errors.append((f.name, str(e)))
 
 if errors:
     st.error("Alguns arquivos não puderam ser processados:")
-    for fname, msg in errors:
-        st.write(f"- **{fname}**: {msg}")
+    err_df = pd.DataFrame(errors, columns=["Arquivo", "Erro"])
+    st.dataframe(err_df, use_container_width=True, hide_index=True)
 
 if not all_parts:
     st.warning("Nenhum arquivo foi consolidado (todos falharam ou estavam sem as colunas).")
     st.stop()
 
 final_df = pd.concat(all_parts, ignore_index=True)
+# Categórica: cada nome de arquivo é guardado uma única vez
+# (uploads diferentes podem ter o mesmo nome, daí o unique/get_indexer)
+categories = pd.Index(file_names).unique()
+codes = np.repeat(categories.get_indexer(file_names), file_lengths)
+final_df.insert(0, "Arquivo", pd.Categorical.from_codes(codes, categories=categories))
 
 st.success(f"Consolidado! Linhas totais: {len(final_df)} | Arquivos OK: {len(all_parts)}")
-st.dataframe(final_df, use_container_width=True)
+show_preview(final_df)
 
 # Download CSV
-csv_bytes = final_df.to_csv(index=False).encode("utf-8-sig")
+csv_bytes = to_csv_bytes(tuple((f.name, f.getvalue()) for f in files), final_df)
 st.download_button(
     "⬇️ Baixar CSV consolidado",
     data=csv_bytes,